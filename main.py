@@ -1,19 +1,30 @@
 # app.py
 import os
-import re
 import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from dotenv import load_dotenv
 load_dotenv()
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import mysql.connector
-import matplotlib.pyplot as plt
+import mysql.connector.pooling
+from mysql.connector import errorcode
 from wordcloud import WordCloud
 
 # Google Gen AI SDK
 from google import genai
 from google.genai import types
+from google.genai import errors
+
+logger = logging.getLogger(__name__)
 
 # # -------------------------
 # # Config (from env)
@@ -34,109 +45,656 @@ DB_USER = st.secrets["database"]["DB_USER"]
 DB_PASSWORD = st.secrets["database"]["DB_PASSWORD"]
 DB_NAME = st.secrets["database"]["DB_NAME"]
 
+SUBJECTS = ["Physics", "Chemistry", "Mathematics", "Computer Science", "English"]
+
 # -------------------------
 # Initialize Gemini client
 # -------------------------
 # client picks up GEMINI_API_KEY from env var by default (per docs)
-client = genai.Client()  # uses env var GEMINI_API_KEY
+@st.cache_resource
+def get_gemini_client():
+    return genai.Client()  # uses env var GEMINI_API_KEY
+
+client = get_gemini_client()
 # Optionally you could initialize with explicit key (not recommended for production)
 
+# classification is a trivial task: the lite model is faster and cheaper for it.
+# Small subjects (<= SENTIMENT_CHUNK_SIZE comments, no stored labels yet) are the
+# exception: analyze_feedback classifies and summarizes in one SUMMARY_MODEL call,
+# since splitting it would add a second round trip to save a few cents
+CLASSIFY_MODEL = "gemini-2.5-flash-lite"
+SUMMARY_MODEL = "gemini-2.5-flash"
+
 # -------------------------
 # DB helpers
 # -------------------------
+DB_CONFIG = dict(
+    host=DB_HOST,
+    port=DB_PORT,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    database=DB_NAME,
+    autocommit=True
+)
+
+@st.cache_resource
+def _pool():
+    # one pool per process, shared across reruns and sessions
+    return mysql.connector.pooling.MySQLConnectionPool(pool_name="fb", pool_size=10, **DB_CONFIG)
+
 def get_db_connection():
-    conn = mysql.connector.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME,
-        autocommit=True
-    )
-    return conn
+    # close() on a pooled connection hands it back to the pool
+    try:
+        return _pool().get_connection()
+    except mysql.connector.errors.PoolError:
+        # every pooled connection is checked out (busy sessions + background
+        # labelling threads): use a one-off connection, close() tears it down
+        return mysql.connector.connect(**DB_CONFIG)
 
 def insert_feedback(student_name, subject, rating, comments):
     conn = get_db_connection()
     cursor = conn.cursor()
     sql = "INSERT INTO feedback (student_name, subject, rating, comments) VALUES (%s,%s,%s,%s)"
     cursor.execute(sql, (student_name, subject, rating, comments))
+    row_id = cursor.lastrowid
     cursor.close()
     conn.close()
+    # new row -> drop cached feedback so the dashboard refreshes
+    _fetch_feedback.clear()
+    fetch_avg_by_subject.clear()
+    fetch_comments_for_subject.clear()
+    # label the comment in the background so the submit isn't held up by Gemini
+    if ensure_sentiment_column():
+        threading.Thread(target=_persist_sentiment, args=(row_id, comments), daemon=True).start()
 
-def fetch_all_feedback():
+SCHEMA_RETRY_SECONDS = 60
+
+@st.cache_resource
+def _sentiment_column_state():
+    # only success is remembered for good; a failure is retried after a pause
+    return {"ready": False, "retry_at": 0.0}
+
+def ensure_sentiment_column():
+    # one-time migration: stored labels mean comments are only ever classified once.
+    # Returns False (app keeps working, labels just aren't stored) if the DB user
+    # can't run it; see the README for the SQL to apply by hand.
+    state = _sentiment_column_state()
+    if state["ready"]:
+        return True
+    if time.time() < state["retry_at"]:
+        return False
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.columns "
+            "WHERE table_schema = %s AND table_name = 'feedback' AND column_name = 'sentiment'",
+            (DB_NAME,)
+        )
+        (exists,) = cursor.fetchone()
+        if not exists:
+            cursor.execute("ALTER TABLE feedback ADD COLUMN sentiment VARCHAR(8) NULL")
+        state["ready"] = True
+    except mysql.connector.Error as e:
+        if e.errno == errorcode.ER_DUP_FIELDNAME:
+            # another app process added it between our check and the ALTER
+            state["ready"] = True
+        else:
+            logger.exception("Could not add feedback.sentiment, retrying in %ds", SCHEMA_RETRY_SECONDS)
+            state["retry_at"] = time.time() + SCHEMA_RETRY_SECONDS
+    finally:
+        cursor.close()
+        conn.close()
+    return state["ready"]
+
+def _sentiment_select():
+    return "sentiment" if ensure_sentiment_column() else "NULL AS sentiment"
+
+def save_sentiments(ids, sentiments):
+    if not ensure_sentiment_column():
+        return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    sql = "UPDATE feedback SET sentiment = %s WHERE id = %s"
+    cursor.executemany(sql, list(zip(sentiments, ids)))
+    cursor.close()
+    conn.close()
+    # both cached views show the sentiment column
+    _fetch_feedback.clear()
+    fetch_comments_for_subject.clear()
+
+def _persist_sentiment(row_id, comments):
+    # runs on a daemon thread: nothing may escape, a failed row is just left NULL
+    # and the dashboard classifies it on the next visit
+    try:
+        labels = classify_sentiments_bulk([comments])
+        if labels and not labels[0].get("fallback"):
+            save_sentiments([row_id], [labels[0]["sentiment"]])
+    except Exception:
+        logger.exception("Background sentiment labelling failed for feedback id %s", row_id)
+
+def _latest_ts():
+    # cheap probe used as the cache key for _fetch_feedback
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(date_submitted) FROM feedback")
+    (latest,) = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    return latest
+
+def _query_df(sql, params=None):
+    # plain cursor instead of pd.read_sql (no SQLAlchemy inspection, no warning)
     conn = get_db_connection()
-    df = pd.read_sql("SELECT * FROM feedback ORDER BY date_submitted DESC", conn)
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    columns = cursor.column_names
+    cursor.close()
     conn.close()
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_feedback(latest_ts):
+    df = _query_df(
+        f"SELECT id, student_name, subject, rating, date_submitted, comments, {_sentiment_select()} "
+        "FROM feedback ORDER BY date_submitted DESC"
+    )
+    df = df.astype({"rating": "int8", "subject": "category"})
+    df["date_submitted"] = pd.to_datetime(df["date_submitted"])
     return df
 
+def fetch_all_feedback():
+    # full table is only reloaded when a newer row shows up (or the ttl expires)
+    return _fetch_feedback(_latest_ts())
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_avg_by_subject():
+    # aggregate in MySQL; only one row per subject comes over the wire
+    sql = (
+        "SELECT subject, AVG(rating) AS avg_rating, COUNT(*) AS n "
+        "FROM feedback GROUP BY subject ORDER BY avg_rating DESC"
+    )
+    # AVG comes back as Decimal
+    return _query_df(sql).astype({"avg_rating": "float64"})
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_comments_for_subject(subject):
+    # newest first: the summary cap keeps the most recent comments
+    sql = (
+        f"SELECT id, comments, {_sentiment_select()} FROM feedback "
+        "WHERE subject = %s AND comments IS NOT NULL ORDER BY date_submitted DESC"
+    )
+    return _query_df(sql, (subject,))
+
 # -------------------------
-# Helper: safe JSON extraction
+# Structured output schemas (Gemini returns validated JSON)
 # -------------------------
-def extract_json(text):
-    # try to find the first JSON array/object in the text
-    m = re.search(r'(\{.*\}|\[.*\])', text, re.S)
-    if m:
-        return m.group(1)
-    return text
+SENTIMENT_LABELS = ["Positive", "Negative", "Neutral"]
+
+SENTIMENT_ITEM_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "id": types.Schema(type=types.Type.INTEGER),
+        "sentiment": types.Schema(type=types.Type.STRING, enum=SENTIMENT_LABELS),
+    },
+    required=["id", "sentiment"],
+)
+
+SENTIMENT_LIST_SCHEMA = types.Schema(type=types.Type.ARRAY, items=SENTIMENT_ITEM_SCHEMA)
+
+ANALYSIS_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "sentiments": SENTIMENT_LIST_SCHEMA,
+        "summary": types.Schema(type=types.Type.STRING),
+    },
+    required=["sentiments", "summary"],
+)
 
 # -------------------------
-# AI: batch sentiment classification
+# Helper: defensive JSON parsing
 # -------------------------
-def classify_sentiments_bulk(comments):
-    if not comments:
-        return []
+_JSON_DECODER = json.JSONDecoder()
+
+def parse_json(text):
+    # structured output should already be clean JSON; if the model still wraps it
+    # (code fences, stray prose), decode from the first bracket without a regex
+    try:
+        return json.loads(text)
+    except ValueError:
+        starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+        if not starts:
+            raise
+        parsed, _ = _JSON_DECODER.raw_decode(text, min(starts))
+        return parsed
+
+# -------------------------
+# Helper: prompt size limits
+# -------------------------
+MAX_COMMENT_CHARS = 300
+MAX_SUMMARY_COMMENTS = 200
+
+def truncate_comment(c):
+    return (c[:MAX_COMMENT_CHARS] + "…") if len(c) > MAX_COMMENT_CHARS else c
 
+# -------------------------
+# AI: batch sentiment classification
+# -------------------------
+def build_sentiment_prompt(comments):
     prompt = (
         "Classify sentiment for each student feedback. "
-        "Return ONLY a JSON array of objects with keys: id (1-based) and sentiment. "
-        "Sentiment must be one of: Positive, Negative, Neutral. "
-        "DO NOT include any extra text.\n\nComments:\n"
+        "Return a JSON array of objects with keys: id (1-based) and sentiment. "
+        "Sentiment must be one of: Positive, Negative, Neutral.\n\nComments:\n"
     )
     for i, c in enumerate(comments, start=1):
         # keep it short to avoid huge prompt sizes
-        prompt += f"{i}. {c}\n"
+        prompt += f"{i}. {truncate_comment(c)}\n"
+    return prompt
+
+SENTIMENT_CHUNK_SIZE = 20
+MAX_CONCURRENT_REQUESTS = 8   # stay well under the free-tier RPM limit
+MAX_RETRIES = 3
+
+def _classify_chunk(chunk, offset, model):
+    prompt = build_sentiment_prompt(chunk)
 
     # set thinking_budget=0 to reduce extra 'reasoning' overhead (faster + cheaper)
     config = types.GenerateContentConfig(
-        thinking_config=types.ThinkingConfig(thinking_budget=0)
+        thinking_config=types.ThinkingConfig(thinking_budget=0),
+        response_mime_type="application/json",
+        response_schema=SENTIMENT_LIST_SCHEMA
     )
 
-    resp = client.models.generate_content(
-        model="gemini-2.5-flash",   # production/flash model in quickstart
-        contents=prompt,
-        config=config
-    )
-    text = resp.text
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            resp = client.models.generate_content(
+                model=model,
+                contents=prompt,
+                config=config
+            )
+            break
+        except errors.APIError as e:
+            # back off on rate limiting, give up on anything else
+            if e.code != 429 or attempt == MAX_RETRIES:
+                raise
+            time.sleep(2 ** attempt)
+    parsed = parse_json(resp.text)
+    # ids are 1-based within the chunk; shift them back to the full list
+    return [{"id": offset + int(item.get("id", 0)), "sentiment": item.get("sentiment", "Neutral")}
+            for item in parsed]
 
-    json_text = extract_json(text)
+def classify_sentiments_bulk(comments, model=CLASSIFY_MODEL):
+    if not comments:
+        return []
+
+    # sync client calls on a bounded thread pool: the shared client is used from
+    # session threads and the per-submit thread, so no event loop is tied to it
+    offsets = range(0, len(comments), SENTIMENT_CHUNK_SIZE)
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as pool:
+        futures = [pool.submit(_classify_chunk, comments[o:o + SENTIMENT_CHUNK_SIZE], o, model)
+                   for o in offsets]
+
+    labels = []
+    for o, future in zip(offsets, futures):
+        try:
+            labels.extend(future.result())
+        except Exception:
+            # fallback: neutral labels for a chunk that failed or could not be parsed
+            logger.exception("Sentiment chunk at offset %d failed, labelling it Neutral", o)
+            chunk_len = min(SENTIMENT_CHUNK_SIZE, len(comments) - o)
+            labels.extend({"id": o + i, "sentiment": "Neutral", "fallback": True}
+                          for i in range(1, chunk_len + 1))
+    return labels
+
+def expand_labels(labels, inverse):
+    # labels were computed on unique comments; map them back onto every row
+    by_id = {int(item.get("id", 0)): item for item in labels}
+    missing = {"sentiment": "Neutral", "fallback": True}
+    expanded = []
+    for i, u in enumerate(inverse, start=1):
+        item = by_id.get(int(u) + 1, missing)
+        expanded.append({"id": i, "sentiment": item.get("sentiment", "Neutral"),
+                         "fallback": item.get("fallback", False)})
+    return expanded
+
+# -------------------------
+# AI: sentiment classification via Batch Mode (large comment sets)
+# -------------------------
+# How the work is split by number of unique comments:
+#   <= SENTIMENT_CHUNK_SIZE   one combined sentiment + summary call (analyze_feedback)
+#   <  BATCH_MIN_COMMENTS     concurrent chunked calls (classify_sentiments_bulk)
+#   >= BATCH_MIN_COMMENTS     Batch API job, polled across reruns (half price, slower)
+BATCH_MIN_COMMENTS = 500
+BATCH_CHUNK_SIZE = 20
+BATCH_RESULTS_MAX = len(SUBJECTS)
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED",
+                     "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+def submit_sentiment_batch(comments, model=CLASSIFY_MODEL):
+    # one request per chunk; the key carries the chunk offset for id remapping
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8") as f:
+        for start in range(0, len(comments), BATCH_CHUNK_SIZE):
+            chunk = comments[start:start + BATCH_CHUNK_SIZE]
+            line = {
+                "key": f"chunk-{start}",
+                "request": {
+                    "contents": [{"parts": [{"text": build_sentiment_prompt(chunk)}]}],
+                    "generation_config": {
+                        "thinking_config": {"thinking_budget": 0},
+                        "response_mime_type": "application/json",
+                        "response_schema": SENTIMENT_LIST_SCHEMA.model_dump(mode="json", exclude_none=True),
+                    },
+                },
+            }
+            f.write(json.dumps(line) + "\n")
+        path = f.name
     try:
-        parsed = json.loads(json_text)
-        return parsed
-    except Exception:
-        # fallback: return simple neutral labels if parsing fails
-        return [{"id": i+1, "sentiment": "Neutral"} for i in range(len(comments))]
+        uploaded = client.files.upload(
+            file=path,
+            config=types.UploadFileConfig(display_name="sentiment-batch", mime_type="jsonl")
+        )
+    finally:
+        os.remove(path)
+    job = client.batches.create(model=model, src=uploaded.name)
+    return job.name
+
+def parse_sentiment_batch(job, n_comments):
+    labels = []
+    if job.state.name == "JOB_STATE_SUCCEEDED":
+        content = client.files.download(file=job.dest.file_name).decode("utf-8")
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            offset = int(result["key"].split("-", 1)[1])
+            try:
+                text = result["response"]["candidates"][0]["content"]["parts"][0]["text"]
+                parsed = parse_json(text)
+            except Exception:
+                continue
+            for item in parsed:
+                labels.append({"id": offset + int(item.get("id", 0)),
+                               "sentiment": item.get("sentiment", "Neutral")})
+    # any comment without a label (failed chunk/job) falls back to Neutral
+    seen = {item["id"] for item in labels}
+    labels += [{"id": i, "sentiment": "Neutral", "fallback": True}
+               for i in range(1, n_comments + 1) if i not in seen]
+    return labels
+
+def classify_sentiments_batch(comments):
+    """Returns labels when the batch job is done, or None while it is still running."""
+    if len(comments) < BATCH_MIN_COMMENTS:
+        return cached_sentiments(comments)
+
+    key = comments_key(comments)
+    state = _batch_state()
+    # in-flight jobs are shared too, so sessions viewing the same subject pay for one job
+    with state["lock"]:
+        if key in state["results"]:
+            return state["results"][key]
+        if key not in state["jobs"]:
+            state["jobs"][key] = submit_sentiment_batch(comments)
+        job_name = state["jobs"][key]
+
+    job = client.batches.get(name=job_name)
+    if job.state.name not in BATCH_DONE_STATES:
+        return None
+
+    labels = parse_sentiment_batch(job, len(comments))
+    with state["lock"]:
+        state["jobs"].pop(key, None)
+        if job.state.name == "JOB_STATE_SUCCEEDED" and not has_fallback(labels):
+            # labels also get persisted to MySQL, so only a few recent results are kept
+            state["results"][key] = labels
+            while len(state["results"]) > BATCH_RESULTS_MAX:
+                state["results"].pop(next(iter(state["results"])))
+    return labels
 
 # -------------------------
 # AI: summarize feedback
 # -------------------------
-def summarize_feedback(comments):
+def summarize_feedback(comments, model=SUMMARY_MODEL):
     if not comments:
         return "No comments to summarize."
     prompt = (
         "Summarize the following student feedback into up to 5 concise bullet points. "
         "Be neutral, short and include main themes only.\n\nComments:\n"
-        + "\n".join([f"- {c}" for c in comments])
+        # capped so a large subject can't blow past the context window; callers pass
+        # comments newest first, so anything past the cap is the oldest and is dropped
+        + "\n".join([f"- {truncate_comment(c)}" for c in comments[:MAX_SUMMARY_COMMENTS]])
     )
     config = types.GenerateContentConfig(
         thinking_config=types.ThinkingConfig(thinking_budget=0)
     )
     resp = client.models.generate_content(
-        model="gemini-2.5-flash",
+        model=model,
         contents=prompt,
         config=config
     )
     return resp.text.strip()
 
+# -------------------------
+# AI: sentiment + summary in one call
+# -------------------------
+def analyze_feedback(comments, model=SUMMARY_MODEL):
+    # needs the summary model; the sentiments come along in the same response
+    if not comments:
+        return {"sentiments": [], "summary": "No comments to summarize."}
+
+    prompt = (
+        "Analyze the following student feedback. Return JSON with keys "
+        "sentiments (array of {id, sentiment}, id is the 1-based comment number, "
+        "sentiment is one of: Positive, Negative, Neutral) and "
+        "summary (up to 5 concise bullet points covering the main themes, neutral tone)."
+        "\n\nComments:\n"
+    )
+    for i, c in enumerate(comments, start=1):
+        prompt += f"{i}. {truncate_comment(c)}\n"
+
+    config = types.GenerateContentConfig(
+        thinking_config=types.ThinkingConfig(thinking_budget=0),
+        response_mime_type="application/json",
+        response_schema=ANALYSIS_SCHEMA
+    )
+    resp = client.models.generate_content(
+        model=model,
+        contents=prompt,
+        config=config
+    )
+    # blocked/empty responses have no text, and valid JSON can still have the wrong shape
+    analysis = None
+    if resp.text:
+        try:
+            analysis = parse_json(resp.text)
+        except ValueError:
+            pass
+    if (isinstance(analysis, dict)
+            and isinstance(analysis.get("sentiments"), list)
+            and isinstance(analysis.get("summary"), str)):
+        return analysis
+
+    # same per-chunk fallback behaviour as the separate calls: any chunk that
+    # still fails there comes back as Neutral labels marked "fallback"
+    logger.warning("Unusable analysis response, falling back to separate calls")
+    return {"sentiments": classify_sentiments_bulk(comments),
+            "summary": summarize_feedback(comments)}
+
+# -------------------------
+# AI result caching (keyed on a hash of the comments)
+# -------------------------
+def comments_key(comments):
+    return hashlib.md5("\n".join(comments).encode("utf-8")).hexdigest()
+
+class _UncachedResult(Exception):
+    # st.cache_data doesn't cache exceptions: raising this from a cached function
+    # hands the value back without storing it
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+def has_fallback(labels):
+    return any(item.get("fallback") for item in labels)
+
+# the leading underscore keeps Streamlit from hashing the comments themselves;
+# the precomputed key already identifies them
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_sentiments(key, _comments):
+    labels = classify_sentiments_bulk(list(_comments))
+    if has_fallback(labels):
+        # don't pin a transient 429/parse failure for the whole ttl
+        raise _UncachedResult(labels)
+    return labels
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_summary(key, _comments):
+    return summarize_feedback(list(_comments))
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_analysis(key, _comments):
+    analysis = analyze_feedback(list(_comments))
+    if has_fallback(analysis["sentiments"]):
+        raise _UncachedResult(analysis)
+    return analysis
+
+@st.cache_resource
+def _batch_state():
+    # batch jobs shared across sessions: comments_key -> job name while running,
+    # comments_key -> labels once done
+    return {"lock": threading.Lock(), "jobs": {}, "results": {}}
+
+def cached_sentiments(comments):
+    try:
+        return _cached_sentiments(comments_key(comments), tuple(comments))
+    except _UncachedResult as e:
+        return e.value
+
+@st.cache_resource
+def _seeded_summaries():
+    # summaries that came back with a combined analysis, so a later summary-only
+    # lookup for the same comments (labels now stored) doesn't call Gemini again
+    return {}
+
+def cached_summary(comments):
+    key = comments_key(comments)
+    seeded = _seeded_summaries().get(key)
+    if seeded is not None:
+        return seeded
+    return _cached_summary(key, tuple(comments))
+
+def cached_analysis(comments):
+    key = comments_key(comments)
+    try:
+        analysis = _cached_analysis(key, tuple(comments))
+    except _UncachedResult as e:
+        analysis = e.value
+    seeded = _seeded_summaries()
+    seeded[key] = analysis["summary"]
+    while len(seeded) > len(SUBJECTS):
+        seeded.pop(next(iter(seeded)), None)
+    return analysis
+
+# -------------------------
+# Word cloud (cached PNG)
+# -------------------------
+# roughly one live image per subject; superseded ones are evicted
+@st.cache_data(max_entries=len(SUBJECTS), show_spinner=False)
+def _wordcloud_png(text_hash, _text):
+    # keyed on text_hash; _text is skipped by Streamlit's hasher
+    wc = WordCloud(width=800, height=300, background_color="white").generate(_text)
+    buf = BytesIO()
+    wc.to_image().save(buf, format="PNG")
+    return buf.getvalue()
+
+# -------------------------
+# Dashboard: subject-wise analysis
+# -------------------------
+# runs as a fragment, so changing the subject only reruns this block
+@st.fragment
+def subject_analysis(subjects):
+    selected_subject = st.selectbox("Choose a subject to analyze", subjects)
+
+    if selected_subject:
+        st.markdown(f"### 📘 {selected_subject}")
+        subj_df = fetch_comments_for_subject(selected_subject)
+        # single pass over the column, shared by the word cloud and Gemini sections
+        comments_arr = subj_df["comments"].dropna().to_numpy()
+
+        # Word cloud
+        st.write("**Word Cloud**")
+        text = " ".join(comments_arr)
+        if text.strip():
+            text_hash = hashlib.md5(text.encode("utf-8")).hexdigest()
+            st.image(_wordcloud_png(text_hash, text), use_container_width=True)
+        else:
+            st.write("No comments to generate word cloud.")
+
+        # Sentiment analysis
+        st.write("**Sentiment Analysis (AI)**")
+        sentiment_box = st.container()
+
+        # AI summary
+        st.write("**AI Summary**")
+        summary_box = st.container()
+
+        if not len(comments_arr):
+            sentiment_box.write("No comments to analyze.")
+            summary_box.write("No comments to summarize.")
+            return
+
+        counts = {"Positive":0, "Negative":0, "Neutral":0}
+        # stored labels are counted directly; only unlabelled rows go to Gemini
+        for lab, n in subj_df["sentiment"].value_counts().items():
+            counts[lab] = counts.get(lab,0) + int(n)
+        pending_df = subj_df[subj_df["sentiment"].isna()]
+        # only unique comments go to Gemini for classification; repeated
+        # "good"/"boring" cost nothing extra
+        uniq, inverse = np.unique(pending_df["comments"].to_numpy(), return_inverse=True)
+
+        # the summary keeps every comment: how often a theme repeats is what makes it a main theme
+        labels = None
+        if len(pending_df) == len(subj_df) and len(comments_arr) <= SENTIMENT_CHUNK_SIZE:
+            # nothing stored yet: one round trip covers sentiments and the summary
+            with sentiment_box, st.spinner("Analyzing feedback via Gemini..."):
+                analysis = cached_analysis(comments_arr)
+            labels, summary = analysis["sentiments"], analysis["summary"]
+            # labels are already one per row
+            inverse = np.arange(len(comments_arr))
+        else:
+            # the summary doesn't depend on the sentiment labels, so it is rendered
+            # before (and independently of) any batch job polling below
+            with summary_box, st.spinner("Summarizing feedback via Gemini..."):
+                summary = cached_summary(comments_arr)
+        summary_box.write(summary)
+        if len(comments_arr) > MAX_SUMMARY_COMMENTS:
+            summary_box.caption(f"Based on the {MAX_SUMMARY_COMMENTS} most recent comments.")
+
+        if len(pending_df):
+            if labels is None:
+                with sentiment_box, st.status("Analyzing sentiments via Gemini...") as status:
+                    labels = classify_sentiments_batch(uniq)
+                    if labels is None:
+                        status.update(label="Gemini batch job running, checking again shortly...")
+                        time.sleep(5)
+                        # app scope: this fragment also runs as part of full-app runs (first
+                        # Dashboard load, sidebar switch), where scope="fragment" is rejected
+                        st.rerun()
+                    status.update(label="Sentiment analysis complete", state="complete")
+            labels = expand_labels(labels, inverse)
+            if has_fallback(labels):
+                sentiment_box.warning("Some comments could not be classified; they are counted "
+                                      "as Neutral for now and will be retried.")
+            for item in labels:
+                lab = item.get("sentiment", "Neutral")
+                counts[lab] = counts.get(lab,0) + 1
+            # persist real labels so these rows never hit Gemini again
+            stored = [(int(row_id), item["sentiment"])
+                      for row_id, item in zip(pending_df["id"], labels) if not item["fallback"]]
+            if stored:
+                save_sentiments(*zip(*stored))
+        sentiment_box.write(counts)
+
 # -------------------------
 # Streamlit UI
 # -------------------------
@@ -148,7 +706,7 @@ menu = st.sidebar.radio("Navigate", ["Submit Feedback", "Dashboard"])
 if menu == "Submit Feedback":
     st.header("Submit Feedback")
     name = st.text_input("Student name")
-    subject = st.selectbox("Subject", ["Physics", "Chemistry", "Mathematics", "Computer Science", "English"])
+    subject = st.selectbox("Subject", SUBJECTS)
     rating = st.slider("Rating (1=poor, 5=excellent)", 1, 5, 4)
     comments = st.text_area("Comments")
 
@@ -169,49 +727,9 @@ else:
     if not df.empty:
         # Average rating per subject
         st.subheader("Average Rating per Subject")
-        avg = df.groupby("subject")["rating"].mean().sort_values(ascending=False)
-        st.bar_chart(avg)
+        avg_df = fetch_avg_by_subject()
+        st.bar_chart(avg_df.set_index("subject")["avg_rating"])
 
         # ---------- Subject-wise analysis ----------
         st.subheader("Subject-wise Analysis")
-        subjects = df["subject"].unique()
-        selected_subject = st.selectbox("Choose a subject to analyze", subjects)
-
-        if selected_subject:
-            st.markdown(f"### 📘 {selected_subject}")
-            subj_df = df[df["subject"] == selected_subject]
-
-            # Word cloud
-            st.write("**Word Cloud**")
-            text = " ".join(subj_df["comments"].dropna().tolist())
-            if text.strip():
-                wc = WordCloud(width=800, height=300, background_color="white").generate(text)
-                fig, ax = plt.subplots(figsize=(10,3))
-                ax.imshow(wc, interpolation="bilinear")
-                ax.axis("off")
-                st.pyplot(fig)
-            else:
-                st.write("No comments to generate word cloud.")
-
-            # Sentiment analysis
-            st.write("**Sentiment Analysis (AI)**")
-            comments_list = subj_df["comments"].dropna().tolist()
-            if comments_list:
-                with st.spinner("Analyzing sentiments via Gemini..."):
-                    labels = classify_sentiments_bulk(comments_list)
-                counts = {"Positive":0, "Negative":0, "Neutral":0}
-                for item in labels:
-                    lab = item.get("sentiment", "Neutral")
-                    counts[lab] = counts.get(lab,0) + 1
-                st.write(counts)
-            else:
-                st.write("No comments to analyze.")
-
-            # AI summary
-            st.write("**AI Summary**")
-            if comments_list:
-                with st.spinner("Summarizing feedback via Gemini..."):
-                    summary = summarize_feedback(comments_list)
-                st.write(summary)
-            else:
-                st.write("No comments to summarize.")
\ No newline at end of file
+        subject_analysis(avg_df["subject"].tolist())